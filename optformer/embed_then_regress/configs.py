@@ -80,6 +80,8 @@ class ModelConfig:
   num_layers: int = 8
   use_metadata: bool = True
   std_transform: str = 'exp'
+  embedder_dtype: str = 'float32'  # Use 'bfloat16' only for frozen encoders.
+  dtype: str = 'float32'  # Computation dtype, e.g. 'bfloat16' (opt-in).
 
   def create_model(
       self, embedder_config: T5EmbedderConfig
@@ -87,10 +89,14 @@ class ModelConfig:
 
     kwargs = dataclasses.asdict(self)
     kwargs.pop('std_transform')
+    kwargs.pop('embedder_dtype')
+    kwargs.pop('dtype')
 
     return icl_transformer.ICLTransformer(
         std_transform_fn=self.create_std_transform_fn(),
         embedder_factory=embedder_config.create_embedder_factory(),
+        embedder_dtype=jnp.dtype(self.embedder_dtype),
+        dtype=jnp.dtype(self.dtype),
         **kwargs,
     )
 
@@ -17,6 +17,7 @@
 import dataclasses
 import functools
 from typing import Callable
+from absl import logging
 from flax import linen as nn
 from flax import struct
 import jax
@@ -36,62 +37,226 @@ EPS = 1e-7
 AnyTensor = jt.Float[jax.Array, '*A']
 
 
+def _supports_cudnn_attention(query: jax.Array) -> bool:
+  """Whether cuDNN's flash attention supports the given queries."""
+  if jax.default_backend() != 'gpu':
+    return False
+  if query.dtype not in (jnp.bfloat16, jnp.float16):
+    return False
+  head_dim = query.shape[-1]
+  if head_dim > 128 or head_dim % 8:
+    return False
+  # Flash attention requires Ampere (compute capability 8.0) or newer.
+  capability = getattr(jax.devices()[0], 'compute_capability', '0')
+  return float(capability) >= 8.0
+
+
+def fused_attention(
+    query: jt.Float[jax.Array, 'B L H D'],
+    key: jt.Float[jax.Array, 'B L H D'],
+    value: jt.Float[jax.Array, 'B L H D'],
+    key_value_seq_lengths: jt.Int[jax.Array, 'B'],
+) -> jt.Float[jax.Array, 'B L H D']:
+  """Dot-product attention over a key prefix (padding) mask.
+
+  Every query attends to keys [0, key_value_seq_lengths). Passing lengths rather
+  than a boolean mask avoids materializing anything LxL.
+
+  On GPU with half precision inputs (and a supported GPU / head dim), dispatches
+  to cuDNN's flash attention, which also avoids materializing the [B, H, L, L]
+  logits in HBM. Otherwise (TPU, CPU, float32 or unsupported GPUs), XLA's
+  attention is used and no fused kernel is involved. Fused kernels do not
+  support dropout on the attention weights.
+
+  Args:
+    query: Projected queries.
+    key: Projected keys.
+    value: Projected values.
+    key_value_seq_lengths: Number of attended (prefix) keys per example. Must
+      be positive, since cuDNN's result is undefined without any keys.
+
+  Returns:
+    Attention output, before the output projection.
+  """
+  attention = functools.partial(
+      jax.nn.dot_product_attention,
+      query,
+      key,
+      value,
+      key_value_seq_lengths=key_value_seq_lengths,
+  )
+  if _supports_cudnn_attention(query):
+    try:
+      return attention(implementation='cudnn')
+    except (NotImplementedError, RuntimeError, ValueError) as e:
+      logging.warning('cuDNN attention unavailable, using XLA: %s', e)
+  return attention(implementation='xla')
+
+
+class PrefixSelfAttention(nn.Module):
+  """Multi-head self-attention over a key prefix mask.
+
+  Parameter layout matches `nn.SelfAttention`.
+  """
+
+  num_heads: int  # H
+  qkv_features: int  # D
+  dtype: jnp.dtype = jnp.float32  # Computation dtype.
+  param_dtype: jnp.dtype = jnp.float32
+
+  def setup(self):
+    dense = functools.partial(
+        nn.DenseGeneral,
+        dtype=self.dtype,
+        param_dtype=self.param_dtype,
+        kernel_init=default_kernel_init,
+    )
+    head_dim = self.qkv_features // self.num_heads
+    self.query = dense(features=(self.num_heads, head_dim))
+    self.key = dense(features=(self.num_heads, head_dim))
+    self.value = dense(features=(self.num_heads, head_dim))
+    self.out = dense(features=self.qkv_features, axis=(-2, -1))
+
+  def __call__(
+      self,
+      x: jt.Float[jax.Array, 'B L D'],
+      key_value_seq_lengths: jt.Int[jax.Array, 'B'],
+  ) -> jt.Float[jax.Array, 'B L D']:
+    out = fused_attention(
+        self.query(x), self.key(x), self.value(x), key_value_seq_lengths
+    )  # [B, L, H, D // H]
+    return self.out(out)
+
+
+# Embedder submodules which can be frozen, unlike e.g. the reduction head.
+_FROZEN_EMBEDDER_MODULES = ('encoder', 'token_embedder')
+
+
+def _cast_embedder_params(variables, dtype: jnp.dtype):
+  """Casts floating-point (frozen) encoder params of `embedder` to `dtype`.
+
+  Args:
+    variables: Model variables, containing the embedder's params.
+    dtype: Storage dtype for the frozen encoder params.
+
+  Returns:
+    Variables with frozen encoder params cast to `dtype`.
+
+  Raises:
+    ValueError: If the embedder has no frozen encoder submodules, i.e. casting
+      would silently be a no-op.
+  """
+  in_embedder, in_encoder = [], []
+
+  def cast(path, v):
+    keys = [getattr(k, 'key', None) for k in path]
+    in_embedder.append('embedder' in keys)
+    in_encoder.append(
+        any(
+            parent == 'embedder' and child in _FROZEN_EMBEDDER_MODULES
+            for parent, child in zip(keys[:-1], keys[1:])
+        )
+    )
+    if in_encoder[-1] and jnp.issubdtype(v.dtype, jnp.floating):
+      return v.astype(dtype)
+    return v
+
+  variables = jax.tree_util.tree_map_with_path(cast, variables)
+  if any(in_embedder) and not any(in_encoder):
+    raise ValueError(
+        f'embedder_dtype={dtype} requires an embedder with submodules named'
+        f' {_FROZEN_EMBEDDER_MODULES} (e.g. FlaxT5Embedder).'
+    )
+  return variables
+
+
 class Block(nn.Module):
-  """Standard attention block with customizable mask."""
+  """Standard attention block, attending to a prefix of keys."""
 
   d_model: int  # D
   num_heads: int  # H
   hidden_dim: int  # F
   dropout_rate: float
+  dtype: jnp.dtype = jnp.float32  # Computation dtype.
+  param_dtype: jnp.dtype = jnp.float32
 
   def setup(self):
-    self.pre_attn_norm = nn.LayerNorm()
-    self.attn = nn.SelfAttention(
+    dense = functools.partial(
+        Dense, dtype=self.dtype, param_dtype=self.param_dtype
+    )
+    # RMSNorm needs a single reduction (vs. mean and variance for LayerNorm).
+    # Always computed in float32 for numerical stability.
+    norm = functools.partial(
+        nn.RMSNorm, dtype=jnp.float32, param_dtype=self.param_dtype
+    )
+
+    self.pre_attn_norm = norm()
+    self.attn = PrefixSelfAttention(
         num_heads=self.num_heads,
         qkv_features=self.d_model,
-        dropout_rate=self.dropout_rate,
-        kernel_init=default_kernel_init,
-        out_kernel_init=default_kernel_init,
+        dtype=self.dtype,
+        param_dtype=self.param_dtype,
     )
 
-    self.pre_ffw_norm = nn.LayerNorm()
+    self.pre_ffw_norm = norm()
     self.ffw = nn.Sequential(
-        [Dense(self.hidden_dim), nn.relu, Dense(self.d_model)]
+        [dense(self.hidden_dim), nn.relu, dense(self.d_model)]
     )
 
     self.dropout = nn.Dropout(rate=self.dropout_rate)
 
   def __call__(
       self,
-      x: jt.Float[jax.Array, 'B* L D'],
-      mask: jt.Float[jax.Array, 'B* H QL KVL'] | None = None,
+      x: jt.Float[jax.Array, 'B L D'],
+      key_value_seq_lengths: jt.Int[jax.Array, 'B'],
       deterministic: bool | None = None,
       rng: jax.Array | None = None,
-  ) -> jt.Float[jax.Array, 'B* L D']:
+  ) -> jt.Float[jax.Array, 'B L D']:
+    # `deterministic` is static, so dropout (and its RNG ops) is only traced
+    # when actually applied, e.g. not during inference or eval.
+    use_dropout = self.dropout_rate > 0.0 and not deterministic
+
     # Pre-attention normalization
     norm1 = self.pre_attn_norm(x)
     # Self-attention layer
-    attn = self.attn(
-        norm1, mask=mask, deterministic=deterministic, dropout_rng=rng
-    )
-    x = x + attn  # Residual connection
+    attn = self.attn(norm1, key_value_seq_lengths)
+    # Fused attention has no weight dropout, so apply it on the output instead.
+    if use_dropout:
+      attn_rng = None if rng is None else jax.random.fold_in(rng, 1)
+      attn = self.dropout(attn, deterministic, attn_rng)
+    x = x + attn.astype(x.dtype)  # Residual connection
     # Pre-feed-forward normalization
     norm2 = self.pre_ffw_norm(x)
     # Feed-forward layer
     ff = self.ffw(norm2)
-    x = x + ff  # Residual connection
+    x = x + ff.astype(x.dtype)  # Residual connection
 
     # Optionally, apply dropout
-    if self.dropout_rate > 0.0:
+    if use_dropout:
       x = self.dropout(x, deterministic, rng)
 
     return x
 
 
+class _ScanBlock(Block):
+  """`Block` with the (carry, output) signature required by `nn.scan`."""
+
+  def __call__(self, x, key_value_seq_lengths, deterministic=None, rng=None):
+    return (
+        super().__call__(x, key_value_seq_lengths, deterministic, rng),
+        None,
+    )
+
+
 @struct.dataclass
 class EmbeddingCache:
-  """Cache for storing previously computed embeddings."""
+  """Cache for storing previously computed embeddings.
 
+  Only valid for fixed historical inputs and mask, i.e. must be reset whenever
+  new context points are added.
+  """
+
+  # Historical embeddings, already zeroed outside of the context (mask).
   x_emb: jt.Float[jax.Array, 'L E'] | None = None
   metadata_emb: jt.Float[jax.Array, 'E'] | None = None
 
@@ -107,37 +272,67 @@ class ICLTransformer(nn.Module):
   use_metadata: bool
   std_transform_fn: Callable[[AnyTensor], AnyTensor]
   embedder_factory: Callable[[], nn.Module]  # __call__: [B, T] -> [B, D]
+  # Storage dtype of the embedder's encoder and token embedding params. Lower
+  # precision (e.g. bfloat16) halves the HBM traffic of the memory-bound
+  # embedding lookups, but should only be used with frozen encoders. Other
+  # (trainable) embedder params, e.g. the reduction head, stay as-is. Requires
+  # `FlaxT5Embedder`'s submodule names, otherwise raises on init.
+  embedder_dtype: jnp.dtype = jnp.float32
+  # Computation dtype of the transformer (e.g. bfloat16 for mixed precision).
+  # Input/output projections, normalization, softmax and the residual stream
+  # remain in float32.
+  dtype: jnp.dtype = jnp.float32
+  param_dtype: jnp.dtype = jnp.float32
 
   def setup(self):
+    dense = functools.partial(
+        Dense, dtype=self.dtype, param_dtype=self.param_dtype
+    )
+
     # For embedding x and metadata tokens.
     self.embedder = self.embedder_factory()
 
-    # X, Y, and concatenated X,Y embedders.
-    self.x_proj = nn.Sequential(
-        [Dense(self.d_model), nn.relu, Dense(self.d_model)]
+    # Input and output projections are computed in float32, to avoid
+    # quantizing y-values and predictions.
+    fp32_dense = functools.partial(dense, dtype=jnp.float32)
+
+    # Single MLP over concatenated (X, Y) features, rather than separate X, Y
+    # and XY projections, to reduce the number of matmuls over [B, L, *].
+    self.xy_proj_in = fp32_dense(self.d_model * 2)
+    self.xy_proj_out = dense(self.d_model)
+    # Metadata enters the first MLP layer via a broadcasted add, equivalent to
+    # (but cheaper than) concatenating it to every token.
+    self.metadata_proj = fp32_dense(self.d_model * 2, use_bias=False)
+
+    # Attention blocks over the context prefix. Scanned over layers, so only a
+    # single block is compiled. Also rematerialized (except for matmul outputs)
+    # to reduce memory consumption during backward pass, on top of `embed`.
+    remat_block = nn.remat(
+        _ScanBlock,
+        policy=jax.checkpoint_policies.dots_with_no_batch_dims_saveable,
+        prevent_cse=False,  # Not needed inside scan.
+        static_argnums=(3,),  # `deterministic`, counting `self`.
     )
-    self.y_proj = nn.Sequential(
-        [Dense(self.d_model), nn.relu, Dense(self.d_model)]
-    )
-    self.xy_proj = nn.Sequential(
-        [Dense(self.d_model * 2), nn.relu, Dense(self.d_model)]
+    self.encoder_stack = nn.scan(
+        remat_block,
+        variable_axes={'params': 0},
+        split_rngs={'params': True, 'dropout': True},
+        in_axes=(nn.broadcast, nn.broadcast, nn.broadcast),
+        length=self.num_layers,
+    )(
+        d_model=self.d_model,
+        num_heads=self.nhead,
+        dropout_rate=self.dropout,
+        hidden_dim=int(self.d_model * self.ffw_dim_ratio),
+        dtype=self.dtype,
+        param_dtype=self.param_dtype,
     )
 
-    # Attention blocks with customizable masks.
-    self.encoder_layers = [
-        Block(
-            d_model=self.d_model,
-            num_heads=self.nhead,
-            dropout_rate=self.dropout,
-            hidden_dim=int(self.d_model * self.ffw_dim_ratio),
-        )
-        for _ in range(self.num_layers)
-    ]
-
-    # Predict mean and logstd.
-    self.mean_logstd_head = nn.Sequential(
-        [Dense(self.d_model), nn.relu, Dense(2)]
-    )
+    # Predict mean and logstd, using separate output layers to avoid splitting
+    # a [B, L, 2] output.
+    self.head = nn.Sequential([fp32_dense(self.d_model), nn.relu])
+    self.mean_head = fp32_dense(1)
+    self.logstd_head = fp32_dense(1)
 
   def __call__(
       self,
@@ -146,36 +341,37 @@ class ICLTransformer(nn.Module):
       mask: jt.Bool[jax.Array, 'B L'],
       deterministic: bool | None = None,
       rng: jax.Array | None = None,
+      metadata_emb: jt.Float[jax.Array, 'B E'] | None = None,
   ) -> tuple[jt.Float[jax.Array, 'B L'], jt.Float[jax.Array, 'B L']]:
     """Main ICL Transformer call, **after** embeddings have been computed."""
 
-    # pylint: disable=invalid-name
-    L = x_emb.shape[1]
-
-    x_emb = self.x_proj(x_emb)  # [B, L, D]
-
     # Force 0.0 values for target points using the mask.
     y = y * mask  # [B, L], element-wise multiplication
 
     y = jnp.expand_dims(y, axis=-1)  # [B, L, 1]
-    yt_emb = self.y_proj(y)  # [B, L, D]
-    xy_emb = self.xy_proj(jnp.concatenate((x_emb, yt_emb), axis=-1))
+    xy_emb = self.xy_proj_in(jnp.concatenate((x_emb, y), axis=-1))  # [B, L, 2D]
+    if metadata_emb is not None:
+      metadata_emb = self.metadata_proj(metadata_emb)  # [B, 2D]
+      xy_emb = xy_emb + jnp.expand_dims(metadata_emb, axis=1)  # [B, L, 2D]
+    xy_emb = self.xy_proj_out(nn.relu(xy_emb))  # [B, L, D]
 
-    # Broadcast mask to all heads and additional axis.
+    # Mask is a prefix, so pass it to attention as per-example lengths:
     # All tokens attend to context tokens: mask[:, :num_ctx] = True
     # and no token attends to target tokens: mask[:, num_ctx:] = False
-    mask = jnp.repeat(jnp.expand_dims(mask, axis=1), L, axis=1)  # [B, L, L]
-    mask = jnp.expand_dims(mask, axis=1)  # [B, 1, L, L]
-
-    out = xy_emb
-    for layer in self.encoder_layers:
-      out = layer(out, mask, deterministic, rng)
-
-    mean, std = jnp.split(self.mean_logstd_head(out), 2, axis=-1)  # [B L 1]
-    std = self.std_transform_fn(std) + EPS
-
-    mean = jnp.squeeze(mean, axis=-1)
-    std = jnp.squeeze(std, axis=-1)
+    # Without context, tokens attend to the first token only, since attention
+    # over zero keys is ill-defined (and inconsistent across backends).
+    num_ctx = jnp.sum(mask, axis=-1, dtype=jnp.int32)  # [B]
+    num_ctx = jnp.maximum(num_ctx, 1)
+
+    # Residual stream is kept in float32 across layers; only the block
+    # internals are computed in `dtype`.
+    out = xy_emb.astype(jnp.float32)
+    out, _ = self.encoder_stack(out, num_ctx, deterministic, rng)
+
+    head_out = self.head(out)  # [B, L, D]
+    mean = self.mean_head(head_out)[..., 0]  # [B, L]
+    logstd = self.logstd_head(head_out)[..., 0]  # [B, L]
+    std = self.std_transform_fn(logstd) + EPS
     return mean, std
 
   def fit(
@@ -189,15 +385,10 @@ class ICLTransformer(nn.Module):
   ) -> tuple[jt.Float[jax.Array, 'B L'], jt.Float[jax.Array, 'B L']]:
     """For training / eval loss metrics only."""
     x_emb = self.embed(x)  # [B, L, E]
-
-    if self.use_metadata:
-      L = x_emb.shape[1]  # pylint: disable=invalid-name
-      metadata_emb = self.embed(metadata)  # [B, E]
-      metadata_emb = jnp.expand_dims(metadata_emb, axis=1)  # [B, 1, E]
-      metadata_emb = jnp.repeat(metadata_emb, L, axis=1)  # [B, L, E]
-      x_emb = jnp.concatenate((x_emb, metadata_emb), axis=-1)  # [B, L, 2E]
-
-    return self.__call__(x_emb, y, mask, deterministic, rng)
+    metadata_emb = self.embed(metadata) if self.use_metadata else None  # [B, E]
+    return self.__call__(
+        x_emb, y, mask, deterministic, rng, metadata_emb=metadata_emb
+    )
 
   def infer(
       self,
@@ -213,40 +404,50 @@ class ICLTransformer(nn.Module):
       EmbeddingCache,
   ]:
     """Friendly for inference, no batch dimension."""
-    if cache.x_emb is None:
-      cache = dataclasses.replace(cache, x_emb=self.embed(x_padded))
+    w_mask = jnp.expand_dims(mask, axis=-1)  # [L, 1]
+    if cache.x_emb is None:  # Mask is fixed for the cache, so apply it once.
+      cache = dataclasses.replace(cache, x_emb=self.embed(x_padded) * w_mask)
     x_pad_emb = cache.x_emb  # [L, E]
     x_targ_emb = self.embed(x_targ)  # [Q, E]
 
-    # Combine target and historical (padded) embeddings.
+    # Combine target and historical (padded) embeddings. Since the mask is a
+    # prefix, targets directly overwrite the rows right after the context.
     target_index = jnp.sum(mask, dtype=jnp.int32)  # [1]
-    padded_target_emb = jnp.zeros_like(x_pad_emb)
-    padded_target_emb = jax.lax.dynamic_update_slice_in_dim(
-        padded_target_emb, x_targ_emb, start_index=target_index, axis=0
-    )
-    w_mask = jnp.expand_dims(mask, axis=-1)  # [L, 1]
-    x_emb = x_pad_emb * w_mask + padded_target_emb * (1 - w_mask)  # [L, E]
+    x_emb = jax.lax.dynamic_update_slice_in_dim(
+        x_pad_emb, x_targ_emb, start_index=target_index, axis=0
+    )  # [L, E]
 
+    metadata_emb = None
     if self.use_metadata:  # Attach metadata embeddings too.
       if cache.metadata_emb is None:
         cache = dataclasses.replace(cache, metadata_emb=self.embed(metadata))
-      metadata_emb = cache.metadata_emb  # [E]
-      metadata_emb = jnp.expand_dims(metadata_emb, axis=0)  # [1, E]
-      metadata_emb = jnp.repeat(metadata_emb, x_emb.shape[0], axis=0)  # [L, E]
-      x_emb = jnp.concatenate((x_emb, metadata_emb), axis=-1)  # [L, 2E]
+      metadata_emb = jnp.expand_dims(cache.metadata_emb, axis=0)  # [1, E]
 
     mean, std = self.__call__(
         x_emb=jnp.expand_dims(x_emb, axis=0),
         y=jnp.expand_dims(y_padded, axis=0),
         mask=jnp.expand_dims(mask, axis=0),
+        metadata_emb=metadata_emb,
         deterministic=True,
     )
     return jnp.squeeze(mean, axis=0), jnp.squeeze(std, axis=0), cache
 
-  @nn.remat  # Reduce memory consumption during backward pass.
+  @nn.remat  # Reduce memory consumption of the embedder's backward pass.
   def embed(
       self, tokens: jt.Int[jax.Array, '*X T']
   ) -> jt.Float[jax.Array, '*X E']:
     reshaped_tokens = jnp.reshape(tokens, (-1, tokens.shape[-1]))
-    embeddings = self.embedder(reshaped_tokens)  # [-1, E]
+    embedder_fn = lambda mdl, t: mdl.embedder(t)
+    if self.embedder_dtype != jnp.float32:
+      # Params are created (and hence stored) in `embedder_dtype`.
+      embedder_fn = nn.map_variables(
+          embedder_fn,
+          'params',
+          trans_out_fn=functools.partial(
+              _cast_embedder_params, dtype=self.embedder_dtype
+          ),
+          init=self.is_initializing(),
+      )
+    embeddings = embedder_fn(self, reshaped_tokens)  # [-1, E]
+    embeddings = embeddings.astype(jnp.float32)
     return jnp.reshape(embeddings, tokens.shape[:-1] + (embeddings.shape[-1],))
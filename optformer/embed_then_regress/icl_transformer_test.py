@@ -0,0 +1,250 @@
+# Copyright 2024 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from flax import linen as nn
+import jax
+import jax.numpy as jnp
+import numpy as np
+from optformer.embed_then_regress import icl_transformer
+from optformer.embed_then_regress import testing
+from absl.testing import absltest
+from absl.testing import parameterized
+
+
+class _PlainEmbedder(nn.Module):
+  """Embedder without `FlaxT5Embedder`'s submodule names."""
+
+  @nn.compact
+  def __call__(self, tokens):
+    return jnp.mean(nn.Embed(64, 8)(tokens), axis=-2)
+
+
+def _example(batch_size: int = 2, length: int = 6, num_tokens: int = 5):
+  rng = np.random.default_rng(0)
+  mask = np.zeros((batch_size, length), dtype=bool)
+  mask[:, : length // 2] = True
+  return dict(
+      x=rng.integers(1, 64, (batch_size, length, num_tokens), dtype=np.int32),
+      y=rng.normal(size=(batch_size, length)).astype(np.float32),
+      metadata=rng.integers(1, 64, (batch_size, num_tokens), dtype=np.int32),
+      mask=mask,
+  )
+
+
+class ICLTransformerTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.batch = _example()
+
+  def _init(self, model: icl_transformer.ICLTransformer):
+    return model.init(
+        jax.random.PRNGKey(0),
+        method=model.fit,
+        deterministic=False,
+        rng=jax.random.PRNGKey(1),
+        **self.batch,
+    )
+
+  @parameterized.parameters((True,), (False,))
+  def test_fit(self, deterministic):
+    model = testing.small_icl_transformer()
+    params = self._init(model)
+    mean, std = model.apply(
+        params,
+        method=model.fit,
+        deterministic=deterministic,
+        rng=jax.random.PRNGKey(2),
+        **self.batch,
+    )
+
+    self.assertEqual(mean.shape, self.batch['y'].shape)
+    self.assertEqual(std.shape, self.batch['y'].shape)
+    self.assertEqual(mean.dtype, np.float32)
+    self.assertTrue(np.all(std > 0.0))
+
+  def test_fit_without_dropout_allows_unset_deterministic(self):
+    model = testing.small_icl_transformer(dropout=0.0)
+    params = self._init(model)
+    mean, _ = model.apply(
+        params, method=model.fit, deterministic=None, **self.batch
+    )
+    self.assertEqual(mean.shape, self.batch['y'].shape)
+
+  def test_scanned_layers_match_unrolled(self):
+    model = testing.small_icl_transformer(dropout=0.0)
+    params = self._init(model)
+
+    x = np.random.default_rng(1).normal(size=(2, 6, 8)).astype(np.float32)
+    num_ctx = np.sum(self.batch['mask'], axis=-1, dtype=np.int32)
+    scanned = model.apply(
+        params,
+        x,
+        num_ctx,
+        True,
+        None,
+        method=lambda m, *args: m.encoder_stack(*args)[0],
+    )
+
+    block = icl_transformer.Block(
+        d_model=8, num_heads=2, hidden_dim=16, dropout_rate=0.0
+    )
+    stacked_params = params['params']['encoder_stack']
+    unrolled = x
+    for i in range(model.num_layers):
+      layer_params = jax.tree.map(lambda p, i=i: p[i], stacked_params)
+      unrolled = block.apply({'params': layer_params}, unrolled, num_ctx, True)
+
+    np.testing.assert_allclose(scanned, unrolled, atol=1e-5)
+
+  def test_fused_attention_matches_prefix_mask(self):
+    rng = np.random.default_rng(1)
+    query, key, value = rng.normal(size=(3, 2, 6, 2, 4)).astype(np.float32)
+    num_ctx = np.array([3, 6], dtype=np.int32)
+
+    mask = np.arange(6)[None, :] < num_ctx[:, None]  # [B, L]
+    expected = nn.dot_product_attention(
+        query, key, value, mask=mask[:, None, None, :]
+    )
+    actual = icl_transformer.fused_attention(query, key, value, num_ctx)
+    np.testing.assert_allclose(actual, expected, atol=1e-5)
+
+  def test_infer_without_context(self):
+    model = testing.small_icl_transformer()
+    params = self._init(model)
+
+    example = {k: v[0] for k, v in self.batch.items()}
+    mean, std, _ = model.apply(
+        params,
+        method=model.infer,
+        x_padded=np.zeros_like(example['x']),
+        y_padded=np.zeros_like(example['y']),
+        x_targ=example['x'][:2],
+        metadata=example['metadata'],
+        mask=np.zeros_like(example['mask']),
+        cache=icl_transformer.EmbeddingCache(),
+    )
+    self.assertTrue(np.all(np.isfinite(mean)))
+    self.assertTrue(np.all(np.isfinite(std)))
+
+  def test_infer_matches_fit(self):
+    model = testing.small_icl_transformer()
+    params = self._init(model)
+
+    # Single example, with 3 context points and 2 queries.
+    example = {k: v[0] for k, v in self.batch.items()}
+    num_ctx, num_query = 3, 2
+    x_padded = example['x'].copy()
+    x_padded[num_ctx:] = 0
+
+    infer_kwargs = dict(
+        x_padded=x_padded,
+        y_padded=example['y'] * example['mask'],
+        x_targ=example['x'][num_ctx : num_ctx + num_query],
+        metadata=example['metadata'],
+        mask=example['mask'],
+    )
+    mean, std, cache = model.apply(
+        params,
+        method=model.infer,
+        cache=icl_transformer.EmbeddingCache(),
+        **infer_kwargs,
+    )
+    self.assertIsNotNone(cache.x_emb)
+    self.assertIsNotNone(cache.metadata_emb)
+
+    # Filled cache should give the same results.
+    cached_mean, cached_std, _ = model.apply(
+        params, method=model.infer, cache=cache, **infer_kwargs
+    )
+    np.testing.assert_allclose(cached_mean, mean, atol=1e-6)
+    np.testing.assert_allclose(cached_std, std, atol=1e-6)
+
+    # Context and query predictions match `fit` on the same (unpadded) data.
+    fit_mean, fit_std = model.apply(
+        params,
+        method=model.fit,
+        deterministic=True,
+        **{k: v[None] for k, v in example.items()},
+    )
+    end = num_ctx + num_query
+    np.testing.assert_allclose(mean[:end], fit_mean[0, :end], atol=1e-5)
+    np.testing.assert_allclose(std[:end], fit_std[0, :end], atol=1e-5)
+
+  def test_embedder_dtype(self):
+    model = testing.small_icl_transformer(embedder_dtype=jnp.bfloat16)
+    params = self._init(model)
+
+    embedder_params = params['params']['embedder']
+    for module in ('token_embedder', 'encoder'):
+      for leaf in jax.tree.leaves(embedder_params[module]):
+        self.assertEqual(leaf.dtype, jnp.bfloat16)
+    # Trainable reduction head and the rest of the model are left as-is.
+    for leaf in jax.tree.leaves(embedder_params['reduction_fn']):
+      self.assertEqual(leaf.dtype, jnp.float32)
+    non_embedder_params = {
+        k: v for k, v in params['params'].items() if k != 'embedder'
+    }
+    for leaf in jax.tree.leaves(non_embedder_params):
+      self.assertEqual(leaf.dtype, jnp.float32)
+
+    mean, _ = model.apply(
+        params, method=model.fit, deterministic=True, **self.batch
+    )
+    self.assertEqual(mean.dtype, jnp.float32)
+
+  def test_embedder_dtype_requires_encoder_submodules(self):
+    model = testing.small_icl_transformer(
+        embedder_dtype=jnp.bfloat16, embedder_factory=_PlainEmbedder
+    )
+    with self.assertRaises(ValueError):
+      self._init(model)
+
+  def test_metadata_broadcast_matches_concatenation(self):
+    model = testing.small_icl_transformer()
+    params = self._init(model)
+
+    rng = np.random.default_rng(1)
+    x_emb = rng.normal(size=(2, 6, 8)).astype(np.float32)
+    metadata_emb = rng.normal(size=(2, 8)).astype(np.float32)
+    y, mask = self.batch['y'], self.batch['mask']
+    mean, std = model.apply(
+        params, x_emb, y, mask, True, metadata_emb=metadata_emb
+    )
+
+    # Equivalent formulation: repeat metadata over L and concatenate to X,
+    # with the metadata projection folded into the first layer's kernel.
+    model_params = params['params']
+    kernel = model_params['xy_proj_in']['kernel']  # [E + 1, 2D]
+    metadata_kernel = model_params['metadata_proj']['kernel']  # [E, 2D]
+    concat_params = dict(model_params)
+    concat_params['xy_proj_in'] = dict(
+        model_params['xy_proj_in'],
+        kernel=np.concatenate([kernel[:-1], metadata_kernel, kernel[-1:]]),
+    )
+    repeated = np.repeat(metadata_emb[:, None, :], x_emb.shape[1], axis=1)
+    concat_mean, concat_std = model.apply(
+        {'params': concat_params},
+        np.concatenate([x_emb, repeated], axis=-1),
+        y,
+        mask,
+        True,
+    )
+
+    np.testing.assert_allclose(mean, concat_mean, atol=1e-5)
+    np.testing.assert_allclose(std, concat_std, atol=1e-5)
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -34,6 +34,13 @@ tfd = tfp.distributions
 EmbeddingCache = icl_transformer.EmbeddingCache
 
 
+def _pad_to_bucket(arr: np.ndarray, multiple: int) -> np.ndarray:
+  """Zero-pads the leading axis up to a multiple of `multiple`."""
+  size = -(-arr.shape[0] // multiple) * multiple
+  pad_width = [(0, size - arr.shape[0])] + [(0, 0)] * (arr.ndim - 1)
+  return np.pad(arr, pad_width)
+
+
 # TODO: Maybe refactor omnipred2 regressor base class.
 @attrs.define
 class StatefulICLRegressor:
@@ -46,6 +53,10 @@ class StatefulICLRegressor:
   # `max_trial_length >= history + query`, kept constant to avoid re-jitting.
   max_trial_length: int = attrs.field(default=200, kw_only=True)  # L
   max_token_length: int = attrs.field(default=256, kw_only=True)  # T
+  # Number of queries is padded to a multiple of this to avoid re-jitting.
+  # Internally, L is extended by `query_bucket_size - 1` slack rows, so that
+  # padded queries always fit.
+  query_bucket_size: int = attrs.field(default=8, kw_only=True)
 
   warper: normalization.StatefulWarper = attrs.field(
       factory=normalization.default_warper, kw_only=True
@@ -60,6 +71,8 @@ class StatefulICLRegressor:
 
   # Jitted function.
   _jit_apply: Callable[..., Any] = attrs.field(init=False)
+  # AOT-compiled `_jit_apply`, keyed by (number of queries, is cache filled).
+  _compiled: dict[tuple[int, bool], Any] = attrs.field(init=False, factory=dict)
 
   def __attrs_post_init__(self):
     self.reset()
@@ -71,16 +84,28 @@ class StatefulICLRegressor:
   def predict(self, xs: Sequence[str]) -> tfd.Distribution:
     """Returns prediction in normalized/warped space."""
     num_query = len(xs)
-
-    mask = np.ones(self.max_trial_length, dtype=bool)
+    num_free = self.max_trial_length - self._num_prev
+    if num_query > num_free:
+      raise ValueError(
+          f'Number of queries ({num_query}) exceeds remaining trial length'
+          f' ({num_free}).'
+      )
+    # Padded queries are never attended to, so their predictions are ignored.
+    x_targ = _pad_to_bucket(self._tokenize(xs), self.query_bucket_size)
+
+    mask = np.ones(self._padded_trial_length, dtype=bool)
     mask[self._num_prev :] = False
 
+    # Use precompiled function if available, otherwise (re)jit.
+    apply_key = (len(x_targ), self._cache.x_emb is not None)
+    apply_fn = self._compiled.get(apply_key, self._jit_apply)
+
     # Need to add batch dimension to all inputs.
-    mean, std, self._cache = self._jit_apply(
+    mean, std, self._cache = apply_fn(
         self.params,
         x_padded=self._all_xt,  # [L, T],
-        y_padded=self.warper.warp(self._all_yt),  # [L],
-        x_targ=self._tokenize(xs),  # [Q, T],
+        y_padded=self.warper.warp(self._all_yt).astype(np.float32),  # [L],
+        x_targ=x_targ,  # [Q, T],
         metadata=self._mt,  # [T],
         mask=mask,  # [L],
         cache=self._cache,
@@ -90,10 +115,51 @@ class StatefulICLRegressor:
     std = std[self._num_prev : self._num_prev + num_query]
     return tfd.Normal(mean, std)
 
+  def precompile(self, num_queries: Sequence[int] | None = None) -> None:
+    """Ahead-of-time compiles inference, to avoid compiling during `predict`.
+
+    Args:
+      num_queries: Numbers of (padded) queries to compile for, which must be
+        multiples of `query_bucket_size`, as used by `predict`. Defaults to a
+        single bucket, i.e. up to `query_bucket_size` queries.
+    """
+    if num_queries is None:
+      num_queries = (self.query_bucket_size,)
+    for q in num_queries:
+      if q <= 0 or q % self.query_bucket_size:
+        raise ValueError(
+            f'Number of queries {q} is not a positive multiple of'
+            f' query_bucket_size ({self.query_bucket_size}).'
+        )
+
+    # pylint: disable=invalid-name
+    L, T = self._padded_trial_length, self.max_token_length
+    kwargs = dict(
+        x_padded=jax.ShapeDtypeStruct((L, T), np.int32),
+        y_padded=jax.ShapeDtypeStruct((L,), np.float32),
+        metadata=jax.ShapeDtypeStruct((T,), np.int32),
+        mask=jax.ShapeDtypeStruct((L,), np.bool_),
+    )
+    for q in num_queries:
+      kwargs['x_targ'] = jax.ShapeDtypeStruct((q, T), np.int32)
+      # Both empty and filled caches are used, with different pytree structure.
+      empty_cache = EmbeddingCache()
+      *_, filled_cache = jax.eval_shape(
+          self._jit_apply, self.params, cache=empty_cache, **kwargs
+      )
+      for cache in (empty_cache, filled_cache):
+        lowered = self._jit_apply.lower(self.params, cache=cache, **kwargs)
+        self._compiled[(q, cache.x_emb is not None)] = lowered.compile()
+
   def absorb(self, xs: Sequence[str], ys: Sequence[float]):
     if len(xs) != len(ys):
       raise ValueError('xs and ys must have the same length.')
     num_pts = len(xs)
+    if self._num_prev + num_pts > self.max_trial_length:
+      raise ValueError(
+          f'Absorbing {num_pts} points exceeds max_trial_length'
+          f' ({self.max_trial_length}).'
+      )
     self._all_xt[self._num_prev : self._num_prev + num_pts] = self._tokenize(xs)
     self._all_yt[self._num_prev : self._num_prev + num_pts] = np.array(ys)
     self._num_prev += num_pts
@@ -106,13 +172,17 @@ class StatefulICLRegressor:
 
   def reset(self) -> None:
     self._all_xt = np.zeros(
-        (self.max_trial_length, self.max_token_length), dtype=np.int32
+        (self._padded_trial_length, self.max_token_length), dtype=np.int32
     )
-    self._all_yt = np.zeros(self.max_trial_length, dtype=np.float32)
+    self._all_yt = np.zeros(self._padded_trial_length, dtype=np.float32)
     self._mt = np.zeros(self.max_token_length, dtype=np.int32)
     self._num_prev = 0
     self._cache = EmbeddingCache()
 
+  @property
+  def _padded_trial_length(self) -> int:
+    return self.max_trial_length + self.query_bucket_size - 1
+
   def _tokenize(self, ss: Sequence[str]) -> jt.Int[np.ndarray, 'S T']:
     """Converts ss (strings) to tokens."""
     batch_size = len(ss)
@@ -0,0 +1,106 @@
+# Copyright 2024 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import jax
+import numpy as np
+from optformer.common.data import vocabs
+from optformer.embed_then_regress import regressor as regressor_lib
+from optformer.embed_then_regress import testing
+from absl.testing import absltest
+
+# pylint: disable=protected-access
+
+MAX_TRIAL_LENGTH = 10
+MAX_TOKEN_LENGTH = 8
+
+
+class StatefulICLRegressorTest(absltest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.vocab = vocabs.SentencePieceVocabulary(vocabs.VOCAB_TEST_MODEL_FILE)
+    self.model = testing.small_icl_transformer()
+
+    example_batch = dict(
+        x=np.ones((1, MAX_TRIAL_LENGTH, MAX_TOKEN_LENGTH), dtype=np.int32),
+        y=np.zeros((1, MAX_TRIAL_LENGTH), dtype=np.float32),
+        metadata=np.ones((1, MAX_TOKEN_LENGTH), dtype=np.int32),
+        mask=np.ones((1, MAX_TRIAL_LENGTH), dtype=bool),
+    )
+    self.params = self.model.init(
+        jax.random.PRNGKey(0),
+        method=self.model.fit,
+        deterministic=True,
+        **example_batch,
+    )
+
+  def _create_regressor(
+      self, query_bucket_size: int
+  ) -> regressor_lib.StatefulICLRegressor:
+    regressor = regressor_lib.StatefulICLRegressor(
+        self.model,
+        self.params,
+        self.vocab,
+        max_trial_length=MAX_TRIAL_LENGTH,
+        max_token_length=MAX_TOKEN_LENGTH,
+        query_bucket_size=query_bucket_size,
+    )
+    regressor.set_metadata('metadata')
+    regressor.absorb(['a', 'bc', 'def', 'gh'], [1.0, 2.0, 0.5, 3.0])
+    return regressor
+
+  def test_padded_queries_do_not_change_predictions(self):
+    xs = ['ab', 'cde', 'f']
+    unpadded = self._create_regressor(query_bucket_size=1).predict(xs)
+    padded = self._create_regressor(query_bucket_size=8).predict(xs)
+
+    self.assertEqual(padded.mean().shape, (len(xs),))
+    np.testing.assert_allclose(padded.mean(), unpadded.mean(), atol=1e-5)
+    np.testing.assert_allclose(padded.stddev(), unpadded.stddev(), atol=1e-5)
+
+  def test_predict_up_to_max_trial_length(self):
+    regressor = self._create_regressor(query_bucket_size=8)
+    xs = ['x'] * (MAX_TRIAL_LENGTH - 4)
+    self.assertEqual(regressor.predict(xs).mean().shape, (len(xs),))
+
+    with self.assertRaises(ValueError):
+      regressor.predict(xs + ['y'])
+
+  def test_precompile(self):
+    xs = ['ab', 'cde', 'f']
+    expected = self._create_regressor(query_bucket_size=8).predict(xs)
+
+    regressor = self._create_regressor(query_bucket_size=8)
+    regressor.precompile([8])
+    self.assertIn((8, False), regressor._compiled)
+    self.assertIn((8, True), regressor._compiled)
+
+    # Fails if `predict` falls back to jitting.
+    def _fail(*args, **kwargs):
+      raise AssertionError('Precompiled function was not used.')
+
+    regressor._jit_apply = _fail
+    for _ in range(2):  # Empty, then filled cache.
+      actual = regressor.predict(xs)
+      np.testing.assert_allclose(actual.mean(), expected.mean(), atol=1e-5)
+      np.testing.assert_allclose(actual.stddev(), expected.stddev(), atol=1e-5)
+
+  def test_precompile_rejects_unused_buckets(self):
+    regressor = self._create_regressor(query_bucket_size=8)
+    with self.assertRaises(ValueError):
+      regressor.precompile([5])
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,56 @@
+# Copyright 2024 Google LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Testing utilities to make life easier."""
+
+from flax import linen as nn
+import jax
+import jax.numpy as jnp
+import jaxtyping as jt
+from optformer.embed_then_regress import icl_transformer
+
+
+class SmallEmbedder(nn.Module):
+  """Small stand-in for `FlaxT5Embedder`, using the same submodule names."""
+
+  vocab_size: int = 64
+  emb_dim: int = 8
+
+  def setup(self):
+    self.token_embedder = nn.Embed(self.vocab_size, self.emb_dim)
+    self.encoder = nn.Dense(self.emb_dim)
+    self.reduction_fn = nn.Dense(self.emb_dim)
+
+  def __call__(
+      self, tokens: jt.Int[jax.Array, 'B T']
+  ) -> jt.Float[jax.Array, 'B E']:
+    logits = self.encoder(self.token_embedder(tokens))  # [B, T, E]
+    logits = logits * jnp.expand_dims(tokens > 0, axis=-1)
+    return self.reduction_fn(jnp.mean(logits, axis=-2))
+
+
+def small_icl_transformer(**kwargs) -> icl_transformer.ICLTransformer:
+  """Make small ICL transformer, with overridable fields."""
+  config = dict(
+      d_model=8,
+      ffw_dim_ratio=2,
+      nhead=2,
+      dropout=0.1,
+      num_layers=2,
+      use_metadata=True,
+      std_transform_fn=jnp.exp,
+      embedder_factory=SmallEmbedder,
+  )
+  config.update(kwargs)
+  return icl_transformer.ICLTransformer(**config)
@@ -14,7 +14,6 @@
 
 """Omnipred-specific vocabulary."""
 
-import functools
 from optformer.common.data import vocabs
 from optformer.common.serialization import numeric
 
@@ -33,11 +32,12 @@ class FloatMetricVocabulary(vocabs.HybridVocabulary[float]):
   ):
 
     self._deserializer = deserializer or DigitByDigitFloatTokenSerializer()
+    extra_tokens = list(self._deserializer.all_tokens_used())
 
-    super().__init__(
-        sentencepiece_model_file,
-        extra_tokens=list(self._deserializer.all_tokens_used()),
-    )
+    super().__init__(sentencepiece_model_file, extra_tokens=extra_tokens)
+    # Computed once here (and pickled along with the rest of the state), so
+    # that access never requires encoding.
+    self._initial_token_id = self.encode(extra_tokens[0])[0]
 
   @property
   def deserializer(self) -> DigitByDigitFloatTokenSerializer:
@@ -49,7 +49,6 @@ class FloatMetricVocabulary(vocabs.HybridVocabulary[float]):
     """Expected decode length, noting initial token ID is always used."""
     return self._deserializer.num_tokens_per_obj + 1
 
-  @functools.cached_property
+  @property
   def initial_token_id(self) -> int:
-    s = ''.join(list(self._deserializer.all_tokens_used()))
-    return self.encode(s)[0]
+    return self._initial_token_id